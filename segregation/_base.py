@@ -225,6 +225,9 @@ class SpatialImplicitIndex:
                 distance=distance,
                 decay=decay,
                 precompute=precompute,
+                # self.data is a fresh copy made for this index, so cached node
+                # ids could never be reused and stale ones are never wanted
+                use_cache=False,
             )
             self._original_data = self.data.copy()
             self.data = access
@@ -0,0 +1,166 @@
+"""Numba shortest path kernels for small pandana networks."""
+
+import numba
+import numpy as np
+from joblib import effective_n_jobs
+from numba import njit, prange
+
+# distance pandana reports for node pairs with no connecting path
+_NO_PATH = 4294967.295
+
+
+@njit(cache=True)
+def _dijkstra(indptr, indices, weights, source, targets):
+    """Single-source Dijkstra on a CSR graph, returning distances to `targets`."""
+    n_nodes = len(indptr) - 1
+    dist = np.full(n_nodes, np.inf)
+    done = np.zeros(n_nodes, dtype=np.bool_)
+    #  binary min-heap stored in two parallel arrays. Every edge is relaxed at most
+    #  once, so the heap never holds more than n_edges + 1 entries
+    heap_dist = np.empty(len(indices) + 1)
+    heap_node = np.empty(len(indices) + 1, dtype=np.int64)
+    heap_dist[0] = 0.0
+    heap_node[0] = source
+    size = 1
+    dist[source] = 0.0
+    while size > 0:
+        d = heap_dist[0]
+        u = heap_node[0]
+        size -= 1
+        #  move the last entry to the root and sift it down
+        if size > 0:
+            last_dist = heap_dist[size]
+            last_node = heap_node[size]
+            i = 0
+            while True:
+                child = 2 * i + 1
+                if child >= size:
+                    break
+                if child + 1 < size and heap_dist[child + 1] < heap_dist[child]:
+                    child += 1
+                if heap_dist[child] >= last_dist:
+                    break
+                heap_dist[i] = heap_dist[child]
+                heap_node[i] = heap_node[child]
+                i = child
+            heap_dist[i] = last_dist
+            heap_node[i] = last_node
+        if done[u]:
+            continue
+        done[u] = True
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            new_dist = d + weights[k]
+            if new_dist < dist[v]:
+                dist[v] = new_dist
+                #  push onto the heap and sift up
+                i = size
+                size += 1
+                while i > 0:
+                    parent = (i - 1) // 2
+                    if heap_dist[parent] <= new_dist:
+                        break
+                    heap_dist[i] = heap_dist[parent]
+                    heap_node[i] = heap_node[parent]
+                    i = parent
+                heap_dist[i] = new_dist
+                heap_node[i] = v
+
+    out = np.empty(len(targets))
+    for j in range(len(targets)):
+        out[j] = dist[targets[j]]
+    return out
+
+
+@njit(parallel=True, cache=True)
+def _multi_source_dijkstra(indptr, indices, weights, sources, targets):
+    """Run an independent Dijkstra search from each source in parallel."""
+    out = np.empty((len(sources), len(targets)), dtype=np.float32)
+    for i in prange(len(sources)):
+        out[i, :] = _dijkstra(indptr, indices, weights, sources[i], targets)
+    return out
+
+
+def _network_to_csr(network):
+    """Convert the default impedance of a pandana.Network into CSR arrays."""
+    nodes = network.nodes_df.index
+    edges = network.edges_df
+    sources = nodes.get_indexer(edges["from"].values)
+    targets = nodes.get_indexer(edges["to"].values)
+    weights = edges[network.impedance_names[0]].values.astype(np.float64)
+    if network._twoway:
+        sources, targets = (
+            np.concatenate([sources, targets]),
+            np.concatenate([targets, sources]),
+        )
+        weights = np.concatenate([weights, weights])
+
+    #  parallel edges are kept as separate entries rather than summed
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=len(nodes)))
+
+    return indptr, targets[order].astype(np.int64), weights[order]
+
+
+def shortest_path_matrix(
+    network, origin_ids, destination_ids, out=None, n_jobs=None, max_pairs=10_000_000
+):
+    """Compute shortest path lengths between every origin and destination node.
+
+    Parameters
+    ----------
+    network : pandana.Network
+        network holding the nodes and edges to search
+    origin_ids : numpy.ndarray
+        node ids of each origin
+    destination_ids : numpy.ndarray
+        node ids of each destination
+    out : numpy.ndarray, optional
+        (len(origin_ids), len(destination_ids)) array, such as a `numpy.memmap`,
+        that is filled in place. If None (default) a float32 array is allocated
+    n_jobs : int, optional
+        number of threads to use. Negative values follow joblib's convention, so
+        -1 uses all cpus. If None (default) numba's thread count is left as is
+    max_pairs : int, optional
+        upper bound on the number of origin-destination lengths held in memory
+        at once. Origins are searched in chunks of this size
+
+    Returns
+    -------
+    numpy.ndarray
+        `out`, holding the path lengths and using the same value as pandana for
+        unreachable pairs
+    """
+    if out is None:
+        out = np.empty((len(origin_ids), len(destination_ids)), dtype=np.float32)
+    nodes = network.nodes_df.index
+    indptr, indices, weights = _network_to_csr(network)
+    #  origins snapped to the same node share a single search. Sorting origins by
+    #  their search lets each chunk of searches be scattered to its rows directly
+    sources, inverse = np.unique(nodes.get_indexer(origin_ids), return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind="stable")
+    sorted_inverse = inverse[order]
+    sources = sources.astype(np.int64)
+    targets = nodes.get_indexer(destination_ids).astype(np.int64)
+    chunksize = max(1, max_pairs // max(len(targets), 1))
+
+    n_threads = numba.get_num_threads()
+    if n_jobs is not None:
+        numba.set_num_threads(
+            min(effective_n_jobs(n_jobs), numba.config.NUMBA_NUM_THREADS)
+        )
+    try:
+        for start in range(0, len(sources), chunksize):
+            stop = start + chunksize
+            lengths = _multi_source_dijkstra(
+                indptr, indices, weights, sources[start:stop], targets
+            )
+            lengths[np.isinf(lengths)] = _NO_PATH
+            first, last = np.searchsorted(sorted_inverse, [start, stop])
+            out[order[first:last]] = lengths[sorted_inverse[first:last] - start]
+    finally:
+        numba.set_num_threads(n_threads)
+
+    return out
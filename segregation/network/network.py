@@ -2,21 +2,187 @@
 
 __author__ = "Elijah Knaap <elijah.knaap@ucr.edu> Renan X. Cortes <renanc@ucr.edu> and Sergio J. Rey <sergio.rey@ucr.edu>"
 
-import geopandas as gpd
+import weakref
+
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
+from pyproj import CRS, Transformer
+from scipy import sparse
 from tqdm.auto import tqdm
 
+from ._sssp import shortest_path_matrix
+
+try:
+    from shapely import get_coordinates as _get_coordinates
+except ImportError:  # shapely<2
+    _get_coordinates = None
+
+# upper bound on the number of origin-destination pairs queried at once, across
+# all threads. Larger matrices are processed in row chunks to bound memory
+_MAX_OD_PAIRS = 10_000_000
+
+# distance decay functions matching those applied by pandana's aggregate
+_DECAY_FUNCTIONS = {
+    "linear": lambda dist, radius: 1 - dist / radius,
+    "exp": lambda dist, radius: np.exp(-dist / radius),
+    "flat": lambda dist, _radius: np.ones_like(dist),
+}
+
+# upper bound on the number of in-range node pairs calc_access holds in memory
+# when weighting several variables at once, and the size of the first batch of
+# nodes used to estimate how many pairs each node has
+_MAX_ACCESS_PAIRS = 10_000_000
+_FIRST_ACCESS_BATCH = 1_000
+
+# node ids snapped for each geodataframe, keyed on id(geodataframe) and then
+# held weakly per network, so repeated calls with the same inputs skip the
+# nearest-node lookup without keeping collected networks alive
+_NODE_ID_CACHE = {}
+
+# radius each network is currently precomputed for. pandana keeps a single
+# precomputed radius, replaced by every precompute call, and reuses it for any
+# query within that distance
+_PRECOMPUTED_RADIUS = weakref.WeakKeyDictionary()
+
 
 def _reproject_osm_nodes(nodes_df, input_crs, output_crs):
-    #  take original x,y coordinates and convert into geopandas.Series, then reproject
-    nodes = gpd.points_from_xy(x=nodes_df.x, y=nodes_df.y, crs=input_crs).to_crs(
-        output_crs
+    #  transform the original x,y coordinate arrays directly, without building
+    #  point geometries
+    transformer = Transformer.from_crs(input_crs, output_crs, always_xy=True)
+    x, y = transformer.transform(nodes_df.x.values, nodes_df.y.values)
+    return pd.DataFrame({"x": x, "y": y}, index=nodes_df.index)
+
+
+def _get_xy(geodataframe):
+    """Return x and y coordinate arrays of point geometries or polygon centroids."""
+    geoms = geodataframe.geometry
+    if not (geoms.geom_type == "Point").all():
+        geoms = geoms.centroid
+    if _get_coordinates is not None:
+        #  read every coordinate pair with one vectorized call; empty or missing
+        #  geometries are skipped by shapely, so only use it if nothing was dropped
+        coords = _get_coordinates(np.asarray(geoms))
+        if len(coords) == len(geoms):
+            return coords[:, 0], coords[:, 1]
+    return geoms.x.values, geoms.y.values
+
+
+def _geometry_fingerprint(geodataframe):
+    """Cheap check for whether a geodataframe's geometries have changed.
+
+    Only the row count and the first and last geometries are compared, so edits
+    to other rows are not detected.
+    """
+    geoms = geodataframe.geometry
+    if len(geoms) == 0:
+        return (0,)
+    return (len(geoms),) + tuple(getattr(g, "wkb", None) for g in geoms.iloc[[0, -1]])
+
+
+def _cached_node_ids(network, geodataframe):
+    """Return the network node nearest each geometry, reusing earlier lookups."""
+    key = id(geodataframe)
+    if key not in _NODE_ID_CACHE:
+        _NODE_ID_CACHE[key] = weakref.WeakKeyDictionary()
+        #  drop the entry when the geodataframe is collected so its id can't be
+        #  reused. Registered once per frame, however often its lookups miss
+        weakref.finalize(geodataframe, _NODE_ID_CACHE.pop, key, None)
+    cache = _NODE_ID_CACHE[key]
+    fingerprint = _geometry_fingerprint(geodataframe)
+    cached = cache.get(network)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    node_ids = np.asarray(network.get_node_ids(*_get_xy(geodataframe)))
+    cache[network] = (fingerprint, node_ids)
+    return node_ids
+
+
+def _snap_origins_destinations(network, origins, destinations):
+    """Find the nearest network node of each origin and destination in one query."""
+    if origins is destinations:
+        node_ids = np.asarray(network.get_node_ids(*_get_xy(origins)))
+        return node_ids, node_ids
+
+    origin_x, origin_y = _get_xy(origins)
+    destination_x, destination_y = _get_xy(destinations)
+    coords = np.column_stack(
+        [
+            np.concatenate([origin_x, destination_x]),
+            np.concatenate([origin_y, destination_y]),
+        ]
+    )
+    #  locations shared by origins and destinations are only looked up once
+    unique, inverse = np.unique(coords, axis=0, return_inverse=True)
+    node_ids = np.asarray(network.get_node_ids(unique[:, 0], unique[:, 1]))
+    node_ids = node_ids[inverse.ravel()]
+    return node_ids[: len(origin_x)], node_ids[len(origin_x) :]
+
+
+def _shortest_path_block(network, origin_ids, destination_ids, out, pbar=None):
+    """Fill `out` with the block of the cost matrix for a subset of origins."""
+    out[:] = (
+        np.asarray(
+            network.shortest_path_lengths(
+                np.repeat(origin_ids, len(destination_ids)),
+                np.tile(destination_ids, len(origin_ids)),
+            )
+        )
+        .astype(np.float32, copy=False)
+        .reshape(out.shape)
     )
-    #  convert to dataframe and recreate the x and y cols
-    nodes = gpd.GeoDataFrame(index=nodes_df.index, geometry=nodes)
-    nodes["x"] = nodes.centroid.x
-    nodes["y"] = nodes.centroid.y
-    return nodes
+    if pbar is not None:
+        pbar.update(len(origin_ids))
+
+
+def _decay_weights(network, nodes, distance, decay):
+    """Build a sparse (len(nodes) x network nodes) matrix of decay weights."""
+    network_nodes = network.nodes_df.index
+    #  the range query lists each reachable node once per source, so there are no
+    #  duplicate pairs to be summed when converting to CSR
+    pairs = network.nodes_in_range(nodes, distance)
+    #  the last column holds the impedance, whose name depends on the network
+    dist = pairs.iloc[:, -1].values
+    sources = pairs["source"].values
+    destinations = pairs["destination"].values
+    keep = (sources != destinations) & (dist <= distance)
+    #  each node is always within reach of itself
+    rows = np.concatenate(
+        [pd.Index(nodes).get_indexer(sources[keep]), np.arange(len(nodes))]
+    )
+    columns = np.concatenate(
+        [
+            network_nodes.get_indexer(destinations[keep]),
+            network_nodes.get_indexer(nodes),
+        ]
+    )
+    dist = np.concatenate([dist[keep], np.zeros(len(nodes))])
+    weights = _DECAY_FUNCTIONS[decay](dist.astype(np.float32), np.float32(distance))
+
+    return sparse.csr_matrix(
+        (weights, (rows, columns)), shape=(len(nodes), len(network_nodes))
+    )
+
+
+def _sparse_access(network, values, distance, decay):
+    """Sum decay-weighted node `values` within `distance` of each network node.
+
+    Nodes are processed in batches so that at most _MAX_ACCESS_PAIRS in-range
+    node pairs are held in memory at once.
+    """
+    nodes = network.nodes_df.index.values
+    access = np.empty(values.shape, dtype=np.float32)
+    start, batchsize = 0, _FIRST_ACCESS_BATCH
+    while start < len(nodes):
+        stop = min(start + batchsize, len(nodes))
+        weights = _decay_weights(network, nodes[start:stop], distance, decay)
+        access[start:stop] = weights @ values
+        #  size the next batch from the neighborhood size seen in this one
+        batchsize = max(1, _MAX_ACCESS_PAIRS * (stop - start) // max(weights.nnz, 1))
+        start = stop
+
+    return access
 
 
 def calc_access(
@@ -27,6 +193,8 @@ def calc_access(
     variables=None,
     precompute=True,
     return_node_data=False,
+    use_cache=True,
+    sparse_weights=False,
 ):
     """Calculate access to population groups.
 
@@ -45,12 +213,24 @@ def calc_access(
     variables : list
         list of variable names present on gdf that should be calculated
     precompute: bool (default True)
-        whether pandana should precompute the distance matrix. It can only be
-        precomputed once, so If you plan to pass the same network to this
-        function several times, you should set precompute=False for later runs
+        whether pandana should precompute the distance matrix. Networks that
+        this function has already precomputed for `distance` or a larger
+        distance are not precomputed again. Not used when `sparse_weights` is
+        True.
     return_node_data : bool, default is False
         Whether to return nodel-level accessibility data or to trim output to
         the same geometries as the input. Default is the latter.
+    use_cache : bool, default is True
+        Whether to reuse the nodes found for the same geodataframe and network
+        in an earlier call. A cached lookup is only invalidated when the number
+        of rows or the first or last geometry changes, so set this to False
+        after editing other geometries of the geodataframe in place.
+    sparse_weights : bool, default is False
+        Whether to build a sparse matrix of decay weights from batched pandana
+        range queries and apply it to all variables at once, instead of one
+        pandana aggregation per variable. pandana's range queries build a
+        DataFrame per node in Python and this path has not been benchmarked
+        against `aggregate`, so it is off by default.
 
     Returns
     -------
@@ -58,37 +238,76 @@ def calc_access(
         DataFrame with two columns, `total_population` and `group_population`
         which represent the total number of each group that can be reached
         within the supplied `distance` parameter. The DataFrame is indexed
-        on node_ids
+        on node_ids. Values are stored as float32
 
     """
     if not decay:
         raise Exception("You must pass a decay function such as `linear`")
-    if precompute:
-        network.precompute(distance)
-
-    geodataframe["node_ids"] = network.get_node_ids(
-        geodataframe.centroid.x, geodataframe.centroid.y
-    )
-    access = []
-    for variable in variables:
-        network.set(
-            geodataframe.node_ids, variable=geodataframe[variable], name=variable
+    #  assign the raw ids so they don't get aligned on the geodataframe's index
+    if use_cache:
+        geodataframe["node_ids"] = _cached_node_ids(network, geodataframe)
+    else:
+        geodataframe["node_ids"] = np.asarray(
+            network.get_node_ids(*_get_xy(geodataframe))
+        )
+    if sparse_weights:
+        if decay not in _DECAY_FUNCTIONS:
+            raise ValueError(
+                f"decay must be one of {list(_DECAY_FUNCTIONS)} when "
+                "sparse_weights is True"
+            )
+        #  build the decay-weighted neighbor matrix once per batch of nodes and
+        #  apply it to every variable in a single sparse product instead of one
+        #  pandana pass each
+        values = (
+            geodataframe.groupby("node_ids")[variables]
+            .sum()
+            .reindex(network.nodes_df.index, fill_value=0)
+            .astype(np.float32)
+        )
+        access = pd.DataFrame(
+            _sparse_access(network, values.values, distance, decay),
+            index=values.index,
+            columns=variables,
         )
+    else:
+        if precompute and distance > _PRECOMPUTED_RADIUS.get(network, -np.inf):
+            network.precompute(distance)
+            _PRECOMPUTED_RADIUS[network] = distance
+        access = []
+        for variable in variables:
+            network.set(
+                geodataframe.node_ids, variable=geodataframe[variable], name=variable
+            )
 
-        access_pop = network.aggregate(distance, type="sum", decay=decay, name=variable)
+            access_pop = network.aggregate(
+                distance, type="sum", decay=decay, name=variable
+            )
+            access_pop = access_pop.astype(np.float32)
+            access_pop.name = variable
 
-        access.append(access_pop)
-    access = pd.DataFrame(dict(zip(variables, access)))
+            access.append(access_pop)
+        access = pd.concat(access, axis=1)
     if return_node_data:
         return access.round(0)
-    access = geodataframe[["node_ids", geodataframe.geometry.name]].merge(
-        access, right_index=True, left_on="node_ids", how="left"
-    )
+    #  access is indexed on unique node ids, so a hash lookup per row is enough to
+    #  attach it to the input geometries
+    result = geodataframe[["node_ids", geodataframe.geometry.name]].copy()
+    for column in access.columns:
+        result[column] = result["node_ids"].map(access[column])
 
-    return access.dropna()
+    return result[result["node_ids"].isin(access.index)]
 
 
-def compute_travel_cost_matrix(origins, destinations, network, reindex_name=None):
+def compute_travel_cost_matrix(
+    origins,
+    destinations,
+    network,
+    reindex_name=None,
+    n_jobs=None,
+    out_path=None,
+    backend="pandana",
+):
     """Compute a shortest path matrix from a pandana network
 
     Parameters
@@ -102,38 +321,95 @@ def compute_travel_cost_matrix(origins, destinations, network, reindex_name=None
     reindex_name : str, optional
         Name of column on the origin/destinatation dataframe that holds unique index values
         If none (default), the index of the pandana Network node will be used
+    n_jobs : int, optional
+        number of threads used to compute shortest paths. Negative values follow
+        joblib's convention (-1 uses all cpus). On the pandana path each thread
+        handles a chunk of origins; pandana already parallelizes each query
+        internally and no speedup from extra threads has been measured, so
+        None (default) uses a single thread there. On the numba path None
+        leaves numba's own thread count in place
+    out_path : str, optional
+        path of a file used to store the matrix on disk as a `numpy.memmap`
+        instead of holding it in memory. Useful when the full
+        matrix does not fit in RAM. Both the numba and pandana code paths write
+        the matrix in chunks of origins. If None (default), or if there are no
+        origins or destinations, the matrix is kept in memory
+    backend : str, optional
+        how shortest paths are computed. "pandana" (default) uses pandana's
+        contraction hierarchy queries. "numba" runs one full Dijkstra search
+        per unique origin node in compiled code; it needs a one-time JIT
+        compile, shows no progress bar, and has not been benchmarked against
+        pandana, so it is only used when requested
 
     Returns
     -------
     pandas.DataFrame
         an origin-destination cost matrix. Rows are origin indices, columns are destination indices,
-        and values are shortest network path cost between the two
+        and values are shortest network path cost between the two. Costs are stored
+        as float32 to halve memory use; cast the result if float64 is needed. If
+        `out_path` is given, the DataFrame is built from the memory-mapped array
     """
-    origins = origins.copy()
-    destinations = destinations.copy()
+    if backend not in ("pandana", "numba"):
+        raise ValueError('backend must be either "pandana" or "numba"')
 
     #  Note: these are not necessarily "OSM" ids, they're just the identifiers for each  node.
     #  with an integrated ped/transit network, these could be bus stops...
-    origins["osm_ids"] = network.get_node_ids(origins.centroid.x, origins.centroid.y)
-
-    destinations["osm_ids"] = network.get_node_ids(
-        destinations.centroid.x, destinations.centroid.y
+    origin_ids, destination_ids = _snap_origins_destinations(
+        network, origins, destinations
     )
 
-    ods = {}
+    n_origins, n_destinations = len(origin_ids), len(destination_ids)
+    #  an empty file can't be memory-mapped, and there is nothing to write anyway
+    streaming = out_path is not None and n_origins > 0 and n_destinations > 0
+    if streaming:
+        #  stream rows to disk so the matrix needn't fit in RAM
+        ods = np.memmap(
+            out_path, dtype=np.float32, mode="w+", shape=(n_origins, n_destinations)
+        )
+    else:
+        ods = np.empty((n_origins, n_destinations), dtype=np.float32)
 
-    with tqdm(total=len(origins["osm_ids"])) as pbar:
-        for origin in origins["osm_ids"]:
-            ods[f"{origin}"] = network.shortest_path_lengths(
-                [origin] * len(origins), destinations["osm_ids"]
+    if backend == "numba":
+        shortest_path_matrix(
+            network, origin_ids, destination_ids, ods, n_jobs, _MAX_OD_PAIRS
+        )
+    else:
+        #  pass the full cartesian product of origins and destinations to pandana
+        #  at once rather than one call per origin. Origins are split into chunks
+        #  small enough that the chunks in flight on all threads together stay
+        #  within _MAX_OD_PAIRS. The progress bar is advanced once per chunk
+        #  (~200 in total), not per origin
+        n_jobs = 1 if n_jobs is None else effective_n_jobs(n_jobs)
+        max_rows = _MAX_OD_PAIRS // (max(n_destinations, 1) * n_jobs)
+        chunksize = max(1, min(max_rows, n_origins // 200))
+        n_chunks = max(n_jobs, -(-n_origins // chunksize))
+        chunks = [
+            slice(c[0], c[-1] + 1)
+            for c in np.array_split(np.arange(n_origins), n_chunks)
+            if len(c)
+        ]
+        #  each thread writes its rows straight into the preallocated matrix
+        with tqdm(total=n_origins, mininterval=0.5, miniters=chunksize) as pbar:
+            Parallel(n_jobs=n_jobs, backend="threading")(
+                delayed(_shortest_path_block)(
+                    network, origin_ids[rows], destination_ids, ods[rows], pbar
+                )
+                for rows in chunks
             )
-            pbar.update(1)
+    if streaming:
+        ods.flush()
 
+    #  under Copy-on-Write the constructor copies ndarrays by default, which would
+    #  duplicate the matrix and read an `out_path` memmap back into memory
     if reindex_name:
-        df = pd.DataFrame(ods, index=origins[reindex_name])
-        df.columns = df.index
+        df = pd.DataFrame(
+            ods,
+            index=origins[reindex_name],
+            columns=destinations[reindex_name],
+            copy=False,
+        )
     else:
-        df = pd.DataFrame(ods, index=origins)
+        df = pd.DataFrame(ods, index=origin_ids, columns=destination_ids, copy=False)
 
     return df
 
@@ -155,7 +431,8 @@ def project_network(network, output_crs=None, input_crs=4326):
     -------
     pandana.Network
         an initialized pandana.Network with 'x' and y' values represented
-        by coordinates in the specified CRS
+        by coordinates in the specified CRS. If the input and output CRS are
+        the same, the original network is returned unchanged
     """
     try:
         import pandana as pdna
@@ -168,7 +445,12 @@ def project_network(network, output_crs=None, input_crs=4326):
 
     assert output_crs, "You must provide an output CRS"
 
-    #  take original x,y coordinates and convert into geopandas.Series, then reproject
+    #  rebuilding the network copies every node and edge, so skip it when the
+    #  coordinates are already in the requested system
+    if CRS.from_user_input(input_crs) == CRS.from_user_input(output_crs):
+        return network
+
+    #  take original x,y coordinates and reproject them into the output crs
     nodes = _reproject_osm_nodes(network.nodes_df, input_crs, output_crs)
 
     #  reinstantiate the network (needs to rebuild the tree)
@@ -1,7 +1,13 @@
 from libpysal.examples import load_example
 import geopandas as gpd
+import numpy as np
 import pandana as pdna
-from segregation.network import calc_access
+import pandas as pd
+import pytest
+from segregation.network import (calc_access, compute_travel_cost_matrix,
+                                  project_network)
+from segregation.network import network as network_module
+from segregation.network._sssp import _NO_PATH, shortest_path_matrix
 
 
 import quilt3 as q3
@@ -20,3 +26,230 @@ def test_calc_access():
 
     acc = calc_access(df, test_net, distance=1., variables=variables)
     assert acc.WHITE.sum() > 100
+
+
+def _toy_network(twoway=True):
+    nodes = pd.DataFrame({"x": [0.0, 1.0, 2.0, 3.0], "y": [0.0, 0.0, 0.0, 1.0]},
+                         index=[10, 11, 12, 13])
+    edges = pd.DataFrame({"from": [10, 11, 12, 10], "to": [11, 12, 13, 13],
+                          "distance": [1.0, 2.0, 3.0, 10.0]})
+    return pdna.Network(nodes.x, nodes.y, edges["from"], edges["to"],
+                        edges[["distance"]], twoway=twoway)
+
+
+@pytest.mark.parametrize("max_pairs", [2, 10_000_000])
+def test_numba_shortest_paths_match_pandana(max_pairs):
+    net = _toy_network()
+    origins = np.array([10, 12, 10])
+    destinations = np.array([11, 13])
+
+    # a preallocated buffer is filled in place, one chunk of origins at a time
+    out = np.full((3, 2), -1, dtype=np.float32)
+    lengths = shortest_path_matrix(net, origins, destinations, out,
+                                   max_pairs=max_pairs)
+    assert lengths is out
+    expected = net.shortest_path_lengths(np.repeat(origins, 2),
+                                         np.tile(destinations, 3))
+    np.testing.assert_allclose(lengths.ravel(), expected)
+
+
+def test_numba_shortest_paths_directed_and_unreachable():
+    # with one-way edges nothing leads back from 13, so 13 -> 10 has no path
+    net = _toy_network(twoway=False)
+    origins = np.array([10, 13, 11])
+    destinations = np.array([13, 10])
+
+    lengths = shortest_path_matrix(net, origins, destinations, n_jobs=-2)
+    expected = net.shortest_path_lengths(np.repeat(origins, 2),
+                                         np.tile(destinations, 3))
+    np.testing.assert_allclose(lengths.ravel(), expected)
+    np.testing.assert_allclose(lengths[:, 1], [0, _NO_PATH, _NO_PATH])
+    np.testing.assert_allclose(lengths[:, 0], [6, 0, 5])
+
+
+@pytest.mark.parametrize("backend", ["pandana", "numba"])
+def test_travel_cost_matrix_unequal_origins_destinations(backend):
+    net = _toy_network()
+    origins = gpd.GeoDataFrame(geometry=gpd.points_from_xy([0, 2], [0, 0]))
+    destinations = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy([1, 3, 0], [0, 1, 0])
+    )
+
+    costs = compute_travel_cost_matrix(origins, destinations, net, n_jobs=1,
+                                       backend=backend)
+    assert costs.shape == (2, 3)
+    np.testing.assert_allclose(costs.values, [[1, 6, 0], [2, 3, 3]])
+
+
+@pytest.mark.parametrize("decay", ["linear", "exp", "flat"])
+def test_sparse_access_matches_pandana_aggregate(monkeypatch, decay):
+    # force several small batches so the batching is exercised too
+    monkeypatch.setattr(network_module, "_FIRST_ACCESS_BATCH", 1)
+    monkeypatch.setattr(network_module, "_MAX_ACCESS_PAIRS", 2)
+    net = _toy_network()
+    net.precompute(4)
+    values = np.array([[1.0, 5.0], [2.0, 0.0], [3.0, 1.0], [4.0, 2.0]],
+                      dtype=np.float32)
+
+    access = network_module._sparse_access(net, values, 4, decay)
+    for i in range(values.shape[1]):
+        net.set(net.nodes_df.index, variable=values[:, i], name="var")
+        expected = net.aggregate(4, type="sum", decay=decay, name="var")
+        np.testing.assert_allclose(access[:, i], expected.values, rtol=1e-5)
+
+
+def _count_node_lookups(monkeypatch, net):
+    calls = []
+    get_node_ids = net.get_node_ids
+
+    def counting(*args, **kwargs):
+        calls.append(1)
+        return get_node_ids(*args, **kwargs)
+
+    monkeypatch.setattr(net, "get_node_ids", counting)
+    return calls
+
+
+def test_cached_node_ids(monkeypatch):
+    import gc
+    import weakref
+    from types import SimpleNamespace
+    import shapely
+
+    finalizers = []
+
+    def finalize(obj, *args):
+        # record only the key so the frame itself isn't kept alive
+        finalizers.append(args[1])
+        return weakref.finalize(obj, *args)
+
+    monkeypatch.setattr(network_module, "weakref", SimpleNamespace(
+        WeakKeyDictionary=weakref.WeakKeyDictionary, finalize=finalize))
+    net = _toy_network()
+    calls = _count_node_lookups(monkeypatch, net)
+    gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy([0, 1, 3], [0, 0, 1]))
+
+    first = network_module._cached_node_ids(net, gdf)
+    np.testing.assert_array_equal(first, [10, 11, 13])
+    # hit: the same frame is not looked up again
+    network_module._cached_node_ids(net, gdf)
+    assert len(calls) == 1
+
+    # miss: changing the first geometry changes the fingerprint
+    gdf.loc[0, "geometry"] = shapely.geometry.Point(2, 0)
+    np.testing.assert_array_equal(network_module._cached_node_ids(net, gdf),
+                                  [12, 11, 13])
+    assert len(calls) == 2
+
+    # misses don't register extra finalizers on the frame
+    assert len(finalizers) == 1
+
+    # eviction: the entry is dropped once the frame is collected
+    key = id(gdf)
+    assert net in network_module._NODE_ID_CACHE[key]
+    del gdf
+    gc.collect()
+    assert key not in network_module._NODE_ID_CACHE
+
+    # entries for collected networks don't outlive the network
+    frame = gpd.GeoDataFrame(geometry=gpd.points_from_xy([0], [0]))
+    other = _toy_network()
+    network_module._cached_node_ids(other, frame)
+    del other
+    gc.collect()
+    assert len(network_module._NODE_ID_CACHE[id(frame)]) == 0
+
+
+def test_calc_access_use_cache(monkeypatch):
+    net = _toy_network()
+    calls = _count_node_lookups(monkeypatch, net)
+    gdf = gpd.GeoDataFrame({"pop": [1.0, 2.0]},
+                           geometry=gpd.points_from_xy([0, 2], [0, 0]))
+
+    calc_access(gdf, net, distance=4, variables=["pop"])
+    calc_access(gdf, net, distance=4, variables=["pop"])
+    assert len(calls) == 1
+    calc_access(gdf, net, distance=4, variables=["pop"], use_cache=False)
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("backend", ["pandana", "numba"])
+def test_travel_cost_matrix_out_path(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(network_module, "_MAX_OD_PAIRS", 3)
+    net = _toy_network()
+    origins = gpd.GeoDataFrame(geometry=gpd.points_from_xy([0, 2, 0], [0, 0, 0]))
+    destinations = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy([1, 3, 0], [0, 1, 0])
+    )
+    out_path = tmp_path / "costs.dat"
+
+    costs = compute_travel_cost_matrix(origins, destinations, net,
+                                       out_path=out_path, backend=backend)
+    expected = [[1, 6, 0], [2, 3, 3], [1, 6, 0]]
+    np.testing.assert_allclose(costs.values, expected)
+    on_disk = np.memmap(out_path, dtype=np.float32, mode="r", shape=(3, 3))
+    np.testing.assert_allclose(on_disk, expected)
+
+    # no origins: nothing is memory-mapped and an empty matrix is returned
+    empty = compute_travel_cost_matrix(origins.iloc[:0], destinations, net,
+                                       out_path=tmp_path / "empty.dat",
+                                       backend=backend)
+    assert empty.shape == (0, 3)
+
+
+def test_calc_access_precomputes_largest_radius_once(monkeypatch):
+    net = _toy_network()
+    radii = []
+    precompute = net.precompute
+
+    def recording(distance):
+        radii.append(distance)
+        precompute(distance)
+
+    monkeypatch.setattr(net, "precompute", recording)
+    gdf = gpd.GeoDataFrame({"pop": [1.0, 2.0]},
+                           geometry=gpd.points_from_xy([0, 2], [0, 0]))
+    for distance in [4, 2, 4, 6]:
+        calc_access(gdf, net, distance=distance, variables=["pop"])
+    assert radii == [4, 6]
+
+
+def test_reproject_osm_nodes():
+    nodes = pd.DataFrame({"x": [0.0, 1.0], "y": [0.0, 0.0]}, index=[10, 11])
+    projected = network_module._reproject_osm_nodes(nodes, 4326, 3857)
+
+    assert list(projected.index) == [10, 11]
+    np.testing.assert_allclose(projected.x, [0.0, 111319.49079327357])
+    np.testing.assert_allclose(projected.y, [0.0, 0.0], atol=1e-6)
+
+
+def test_project_network():
+    net = _toy_network()
+    projected = project_network(net, output_crs=3857)
+
+    assert projected is not net
+    np.testing.assert_allclose(projected.nodes_df.x.loc[[10, 11]],
+                               [0.0, 111319.49079327357])
+    np.testing.assert_array_equal(projected.edges_df["from"], net.edges_df["from"])
+    # edge weights carry over, so path lengths are unchanged
+    np.testing.assert_allclose(projected.shortest_path_lengths([10], [13]), [6])
+
+
+def test_project_network_same_crs_returns_input():
+    net = _toy_network()
+    # the same network object is returned, so later set/precompute calls on the
+    # result also modify the input
+    assert project_network(net, output_crs="EPSG:4326", input_crs=4326) is net
+
+
+def test_calc_access_sparse_weights_opt_in():
+    net = _toy_network()
+    gdf = gpd.GeoDataFrame({"a": [1.0, 2.0, 3.0], "b": [4.0, 0.0, 1.0]},
+                           geometry=gpd.points_from_xy([0, 2, 3], [0, 0, 1]))
+
+    default = calc_access(gdf, net, distance=4, variables=["a", "b"],
+                          return_node_data=True)
+    fused = calc_access(gdf, net, distance=4, variables=["a", "b"],
+                        return_node_data=True, sparse_weights=True)
+    pd.testing.assert_frame_equal(default, fused.loc[default.index],
+                                  check_dtype=False, check_names=False)